@@ -1,18 +1,142 @@
 import os
 import aiosqlite
 import asyncio
+import time
+import xxhash
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional, Tuple
+from typing import AsyncIterator, List, Optional, Tuple
+
+POOL_SIZE = 5
+CACHE_TTL = 60  # seconds
+# Connection-level cache of prepared statements, keyed by SQL text; keeping
+# every statement below as a fixed constant lets each one be prepared once
+CACHED_STATEMENTS = 256
+
+SQL_KNOWN_HASHES = "SELECT content_hash FROM messages WHERE content_hash IS NOT NULL"
+SQL_UPSERT_SUBSCRIBER = """
+    INSERT INTO users (user_id, username, is_subscribed) VALUES (?, ?, TRUE)
+    ON CONFLICT (user_id) DO UPDATE SET is_subscribed = TRUE, username = excluded.username
+"""
+SQL_UNSUBSCRIBE_USER = "UPDATE users SET is_subscribed = FALSE WHERE user_id = ?"
+SQL_SUBSCRIBED_USERS = "SELECT user_id FROM users WHERE is_subscribed = TRUE"
+SQL_ADD_CHANNEL = "INSERT OR REPLACE INTO channels (channel_id, channel_name, channel_username, added_by) VALUES (?, ?, ?, ?)"
+SQL_REMOVE_CHANNEL = "DELETE FROM channels WHERE channel_id = ?"
+SQL_CHANNELS = "SELECT channel_id, channel_name, channel_username FROM channels"
+SQL_ADD_MESSAGE = "INSERT OR IGNORE INTO messages (channel_id, content, message_date, content_hash, source, message_link) VALUES (?, ?, ?, ?, ?, ?) RETURNING message_id"
+# Skips rows that collide on either unique key: the Telegram (chat, message id)
+# pair or the content hash shared with messages forwarded to the bot
+SQL_ADD_MESSAGES = """
+    INSERT OR IGNORE INTO messages (channel_id, tg_message_id, content, message_date, content_hash, source, message_link)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_MAX_TG_MESSAGE_ID = "SELECT MAX(tg_message_id) FROM messages WHERE channel_id = ?"
+SQL_UNPROCESSED_MESSAGES = "SELECT message_id, content, message_date, message_link FROM messages WHERE processed = FALSE ORDER BY message_date DESC"
+SQL_MARK_PROCESSED = "UPDATE messages SET processed = TRUE WHERE message_id = ?"
+SQL_SAVE_DIGEST = "INSERT OR REPLACE INTO digests (date, content) VALUES (?, ?)"
+SQL_LATEST_DIGEST = "SELECT content FROM digests ORDER BY created_at DESC LIMIT 1"
+# A bare range on message_date (instead of DATE(message_date) = ...) lets
+# SQLite walk idx_messages_date; the bounds are still today's UTC date
+SQL_TODAYS_MESSAGES = """
+    SELECT message_id, content, message_date, message_link
+    FROM messages
+    WHERE message_date >= DATE('now') AND message_date < DATE('now', '+1 day')
+    ORDER BY message_date DESC
+"""
+
+
+def hash_content(text: str) -> bytes:
+    """Dedup key for messages.content_hash: the 16-byte XXH3-128 digest"""
+    # Keep this inline: a thread hop costs far more than hashing a chat message
+    return xxhash.xxh3_128_digest(text.encode())
+
+
+class _Pool:
+    """Fixed set of open connections: one reserved writer plus a queue of readers.
+
+    SQLite in WAL mode allows many concurrent readers but only one writer, so
+    writes are serialized on a single connection while reads are spread over
+    the rest.
+    """
+
+    def __init__(self, db_path: str, size: int = POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path, cached_statements=CACHED_STATEMENTS)
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA mmap_size=268435456")
+        await db.execute("PRAGMA cache_size=-20000")
+        return db
+
+    async def open(self):
+        self._writer = await self._connect()
+        # WAL is persistent in the database file, so it only needs to be set once.
+        # Fetch the result so the statement is finalized before readers connect.
+        await self._writer.execute_fetchall("PRAGMA journal_mode=WAL")
+        for _ in range(max(self.size - 1, 1)):
+            self._readers.put_nowait(await self._connect())
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow a read connection for the duration of the block"""
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def write(self):
+        """Hold the writer connection; an error or cancellation inside the block rolls back"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def close(self):
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
 
 
 class Database:
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, pool_size: int = POOL_SIZE):
         if db_path is None:
             db_path = os.getenv("DATABASE_PATH", "ezra.db")
         self.db_path = db_path
+        self.pool_size = pool_size
+        self._pool: _Pool | None = None
+        # Hashes already stored in messages; a hit means a guaranteed duplicate
+        self._known_hashes: set = set()
+        # (timestamp, rows) snapshots of small, rarely-changing tables
+        self._subs_cache: tuple[float, List[int]] | None = None
+        self._channels_cache: tuple[float, List[Tuple[int, str, str]]] | None = None
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        try:
+            await self._init_db()
+        except BaseException:
+            # Don't leave connection threads running behind a failed startup
+            await self.close()
+            raise
+
+    async def _init_db(self):
+        if self._pool is None:
+            self._pool = _Pool(self.db_path, self.pool_size)
+            await self._pool.open()
+
+        async with self._pool.write() as db:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -21,7 +145,7 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            
+
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS channels (
                     channel_id INTEGER PRIMARY KEY,
@@ -32,7 +156,7 @@ class Database:
                     FOREIGN KEY (added_by) REFERENCES users (user_id)
                 )
             """)
-            
+
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS messages (
                     message_id INTEGER PRIMARY KEY,
@@ -40,14 +164,15 @@ class Database:
                     content TEXT,
                     message_date TIMESTAMP,
                     processed BOOLEAN DEFAULT FALSE,
-                    content_hash TEXT,
+                    content_hash BLOB,
+                    tg_message_id INTEGER,
                     source TEXT DEFAULT 'bot',
                     message_link TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (channel_id) REFERENCES channels (channel_id)
                 )
             """)
-            
+
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS digests (
                     digest_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -56,157 +181,220 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            
+
+            # Databases created before these columns existed need them added
+            cursor = await db.execute("PRAGMA table_info(messages)")
+            columns = {row[1] for row in await cursor.fetchall()}
+            for column, column_type in (('message_link', 'TEXT'), ('tg_message_id', 'INTEGER')):
+                if column not in columns:
+                    await db.execute(f"ALTER TABLE messages ADD COLUMN {column} {column_type}")
+            await db.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_tg_message ON messages (channel_id, tg_message_id)
+            """)
+            if 'tg_message_id' not in columns:
+                # Recover ids of rows the userbot stored earlier from their links
+                # (t.me/<chat>/<id>), so the first fetch doesn't re-add them
+                cursor = await db.execute(
+                    "SELECT message_id, message_link FROM messages WHERE source = 'userbot' AND message_link IS NOT NULL"
+                )
+                backfill = [
+                    (int(tg_id), message_id)
+                    for message_id, link in await cursor.fetchall()
+                    if (tg_id := link.rsplit('/', 1)[-1]).isdigit()
+                ]
+                await db.executemany("UPDATE OR IGNORE messages SET tg_message_id = ? WHERE message_id = ?", backfill)
+
+            # A unique index (rather than a column constraint) so existing
+            # databases pick up the dedup guarantee as well
+            await db.execute("DROP INDEX IF EXISTS idx_messages_content_hash")
+            cursor = await db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_messages_content_hash_unique'"
+            )
+            if await cursor.fetchone() is None:
+                # The old check-then-insert could race between the bot and the
+                # userbot and store a hash twice; keep the first copy of each
+                await db.execute("""
+                    DELETE FROM messages WHERE content_hash IS NOT NULL AND message_id NOT IN (
+                        SELECT MIN(message_id) FROM messages WHERE content_hash IS NOT NULL GROUP BY content_hash
+                    )
+                """)
+            await db.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_content_hash_unique ON messages (content_hash)
+            """)
+            # Rows from before hash_content still hold hex MD5 text; rehash them
+            # so new messages from either source dedup against them
+            cursor = await db.execute("SELECT message_id, content FROM messages WHERE typeof(content_hash) = 'text'")
+            await db.executemany(
+                "UPDATE OR IGNORE messages SET content_hash = ? WHERE message_id = ?",
+                [(hash_content(content or ''), message_id) for message_id, content in await cursor.fetchall()]
+            )
+
+            # Covering partial index for the digest query: rows leave it once
+            # processed, and it holds every selected column so the table is
+            # never touched. processed is included because SQLite needs it
+            # present to treat the index as covering.
+            await db.execute("DROP INDEX IF EXISTS idx_messages_processed")
             await db.execute("""
-                CREATE INDEX IF NOT EXISTS idx_messages_content_hash ON messages (content_hash)
+                CREATE INDEX IF NOT EXISTS idx_messages_unprocessed
+                ON messages (message_date DESC, content, message_link, processed)
+                WHERE processed = FALSE
             """)
-            
+
             await db.execute("""
-                CREATE INDEX IF NOT EXISTS idx_messages_processed ON messages (processed)
+                CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (message_date)
             """)
-            
+
             await db.commit()
 
-    async def add_user(self, user_id: int, username: str = None) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute(
-                    "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-                    (user_id, username)
-                )
-                await db.commit()
-                return True
-            except Exception:
-                return False
+        async with self._pool.acquire() as db:
+            cursor = await db.execute(SQL_KNOWN_HASHES)
+            self._known_hashes = {row[0] for row in await cursor.fetchall()}
 
-    async def subscribe_user(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute(
-                    "UPDATE users SET is_subscribed = TRUE WHERE user_id = ?",
-                    (user_id,)
-                )
+    async def upsert_subscriber(self, user_id: int, username: str = None) -> bool:
+        """Create the user if needed and (re)subscribe them in a single statement"""
+        try:
+            async with self._pool.write() as db:
+                await db.execute(SQL_UPSERT_SUBSCRIBER, (user_id, username))
                 await db.commit()
-                return True
-            except Exception:
-                return False
+            self._subs_cache = None
+            return True
+        except Exception:
+            return False
 
     async def unsubscribe_user(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute(
-                    "UPDATE users SET is_subscribed = FALSE WHERE user_id = ?",
-                    (user_id,)
-                )
+        try:
+            async with self._pool.write() as db:
+                await db.execute(SQL_UNSUBSCRIBE_USER, (user_id,))
                 await db.commit()
-                return True
-            except Exception:
-                return False
+            self._subs_cache = None
+            return True
+        except Exception:
+            return False
 
     async def get_subscribed_users(self) -> List[int]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT user_id FROM users WHERE is_subscribed = TRUE"
-            )
+        if self._subs_cache and time.monotonic() - self._subs_cache[0] < CACHE_TTL:
+            return self._subs_cache[1]
+
+        async with self._pool.acquire() as db:
+            cursor = await db.execute(SQL_SUBSCRIBED_USERS)
             result = await cursor.fetchall()
-            return [row[0] for row in result]
+        users = [row[0] for row in result]
+        self._subs_cache = (time.monotonic(), users)
+        return users
 
     async def add_channel(self, channel_id: int, channel_name: str, channel_username: str, added_by: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute(
-                    "INSERT OR REPLACE INTO channels (channel_id, channel_name, channel_username, added_by) VALUES (?, ?, ?, ?)",
-                    (channel_id, channel_name, channel_username, added_by)
-                )
+        try:
+            async with self._pool.write() as db:
+                await db.execute(SQL_ADD_CHANNEL, (channel_id, channel_name, channel_username, added_by))
                 await db.commit()
-                return True
-            except Exception:
-                return False
+            self._channels_cache = None
+            return True
+        except Exception:
+            return False
 
     async def remove_channel(self, channel_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
+        try:
+            async with self._pool.write() as db:
+                await db.execute(SQL_REMOVE_CHANNEL, (channel_id,))
                 await db.commit()
-                return True
-            except Exception:
-                return False
+            self._channels_cache = None
+            return True
+        except Exception:
+            return False
 
     async def get_channels(self) -> List[Tuple[int, str, str]]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT channel_id, channel_name, channel_username FROM channels"
-            )
-            return await cursor.fetchall()
+        if self._channels_cache and time.monotonic() - self._channels_cache[0] < CACHE_TTL:
+            return self._channels_cache[1]
 
-    async def add_message(self, channel_id: int, content: str, message_date: datetime, content_hash: str, source: str = 'bot', message_link: str = None) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                cursor = await db.execute(
-                    "SELECT COUNT(*) FROM messages WHERE content_hash = ?",
-                    (content_hash,)
-                )
-                count = (await cursor.fetchone())[0]
-                
-                if count > 0:
-                    return False
-                
-                await db.execute(
-                    "INSERT INTO messages (channel_id, content, message_date, content_hash, source, message_link) VALUES (?, ?, ?, ?, ?, ?)",
-                    (channel_id, content, message_date, content_hash, source, message_link)
-                )
+        async with self._pool.acquire() as db:
+            cursor = await db.execute(SQL_CHANNELS)
+            channels = await cursor.fetchall()
+        self._channels_cache = (time.monotonic(), channels)
+        return channels
+
+    async def add_message(self, channel_id: int, content: str, message_date: datetime, content_hash: bytes, source: str = 'bot', message_link: str = None) -> bool:
+        if content_hash in self._known_hashes:
+            return False
+
+        try:
+            async with self._pool.write() as db:
+                cursor = await db.execute(SQL_ADD_MESSAGE, (channel_id, content, message_date, content_hash, source, message_link))
+                inserted = await cursor.fetchone() is not None
+                await cursor.close()
                 await db.commit()
-                return True
-            except Exception:
-                return False
+            # Either inserted now or already stored (e.g. by the userbot process)
+            self._known_hashes.add(content_hash)
+            return inserted
+        except Exception:
+            return False
 
-    async def get_unprocessed_messages(self) -> List[Tuple[int, str, datetime, str]]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT message_id, content, message_date, message_link FROM messages WHERE processed = FALSE ORDER BY message_date DESC"
-            )
-            return await cursor.fetchall()
+    async def add_messages_bulk(self, rows: List[Tuple[int, int, str, datetime, bytes, str, Optional[str]]]) -> int:
+        """Insert (channel_id, tg_message_id, content, message_date, content_hash, source, message_link)
+        rows in one batch, skipping messages already stored; returns how many were new"""
+        rows = [row for row in rows if row[4] not in self._known_hashes]
+        if not rows:
+            return 0
 
-    async def mark_messages_processed(self, message_ids: List[int]) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                placeholders = ','.join('?' * len(message_ids))
-                await db.execute(
-                    f"UPDATE messages SET processed = TRUE WHERE message_id IN ({placeholders})",
-                    message_ids
-                )
+        try:
+            async with self._pool.write() as db:
+                cursor = await db.executemany(SQL_ADD_MESSAGES, rows)
+                inserted = cursor.rowcount
                 await db.commit()
-                return True
-            except Exception:
-                return False
+            self._known_hashes.update(row[4] for row in rows)
+            return inserted
+        except Exception:
+            return 0
+
+    async def get_max_tg_message_id(self, channel_id: int) -> int:
+        """Highest Telegram message id stored for the chat, or 0 if there is none"""
+        async with self._pool.acquire() as db:
+            cursor = await db.execute(SQL_MAX_TG_MESSAGE_ID, (channel_id,))
+            row = await cursor.fetchone()
+        return row[0] or 0
+
+    async def iter_unprocessed_messages(self) -> AsyncIterator[Tuple[int, str, datetime, str]]:
+        """Yield unprocessed messages as SQLite produces them instead of materializing them all"""
+        async with self._pool.acquire() as db:
+            async with db.execute(SQL_UNPROCESSED_MESSAGES) as cursor:
+                async for row in cursor:
+                    yield row
 
     async def save_digest(self, date: str, content: str) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute(
-                    "INSERT OR REPLACE INTO digests (date, content) VALUES (?, ?)",
-                    (date, content)
-                )
+        try:
+            async with self._pool.write() as db:
+                await db.execute(SQL_SAVE_DIGEST, (date, content))
+                await db.commit()
+            return True
+        except Exception:
+            return False
+
+    async def finalize_digest(self, date: str, content: str, message_ids: List[int]) -> bool:
+        """Save the digest and mark its source messages processed in one transaction"""
+        try:
+            async with self._pool.write() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                await db.execute(SQL_SAVE_DIGEST, (date, content))
+                # One prepared statement reused per id, so there is no
+                # placeholder limit to overflow on large backlogs
+                await db.executemany(SQL_MARK_PROCESSED, [(message_id,) for message_id in message_ids])
                 await db.commit()
-                return True
-            except Exception:
-                return False
+            return True
+        except Exception:
+            return False
 
     async def get_latest_digest(self) -> Optional[str]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT content FROM digests ORDER BY created_at DESC LIMIT 1"
-            )
+        async with self._pool.acquire() as db:
+            cursor = await db.execute(SQL_LATEST_DIGEST)
             result = await cursor.fetchone()
             return result[0] if result else None
 
     async def get_todays_messages(self) -> List[Tuple[int, str, datetime, str]]:
         """Get all messages from today for regenerating digest"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                """SELECT message_id, content, message_date, message_link 
-                   FROM messages 
-                   WHERE DATE(message_date) = DATE('now') 
-                   ORDER BY message_date DESC"""
-            )
-            return await cursor.fetchall()
\ No newline at end of file
+        async with self._pool.acquire() as db:
+            cursor = await db.execute(SQL_TODAYS_MESSAGES)
+            return await cursor.fetchall()
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
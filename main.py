@@ -1,17 +1,18 @@
 import os
 import asyncio
-import hashlib
+import json
 import logging
-from datetime import datetime, time
+import time
 from typing import List
 
+import httpx
 from telegram import Update, Chat
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from dotenv import load_dotenv
 
-from database import Database
+from database import Database, hash_content
 from llm_service import LLMService
 
 load_dotenv(override=False)  # Don't override existing environment variables
@@ -22,6 +23,9 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 ADMIN_USERNAME = "jewpacabra"
+BROADCAST_CONCURRENCY = 25
+BROADCAST_RATE = 30  # messages per second, Telegram's limit for bulk sends
+BROADCAST_MAX_RETRIES = 3  # per user, after a 429
 
 class EzraBot:
     def __init__(self):
@@ -29,6 +33,7 @@ class EzraBot:
         self.llm = LLMService()
         self.scheduler = AsyncIOScheduler()
         self.application = None
+        self._http: httpx.AsyncClient | None = None
 
     async def initialize(self):
         await self.db.init_db()
@@ -38,6 +43,12 @@ class EzraBot:
             raise ValueError("TELEGRAM_BOT_TOKEN environment variable is required")
         
         self.application = Application.builder().token(token).build()
+        # Shared HTTP/2 client for digest broadcasts: one connection serves every send
+        self._http = httpx.AsyncClient(
+            http2=True,
+            base_url=f"https://api.telegram.org/bot{token}",
+            timeout=30
+        )
         
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CommandHandler("stop", self.stop_command))
@@ -50,8 +61,7 @@ class EzraBot:
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        await self.db.add_user(user.id, user.username)
-        await self.db.subscribe_user(user.id)
+        await self.db.upsert_subscriber(user.id, user.username)
         
         await update.message.reply_text(
             "Welcome to Ezra! 🤖\n\n"
@@ -178,26 +188,62 @@ class EzraBot:
             # Pass full message data for source link generation
             digest = await self.llm.generate_digest_with_sources(messages)
             
-            today = datetime.now().strftime("%Y-%m-%d")
+            today = time.strftime("%Y-%m-%d")
             await self.db.save_digest(today, digest)
             
             subscribed_users = await self.db.get_subscribed_users()
-            
-            for user_id in subscribed_users:
-                try:
-                    await self.application.bot.send_message(
-                        chat_id=user_id,
-                        text=digest,
-                        parse_mode='Markdown'
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send digest to user {user_id}: {e}")
+            await self._broadcast_digest(digest, subscribed_users)
             
             logger.info(f"Digest regenerated and sent to {len(subscribed_users)} users")
             
         except Exception as e:
             logger.error(f"Error regenerating digest: {e}")
 
+    async def _broadcast_digest(self, digest: str, user_ids: List[int]):
+        """Send the digest to all users concurrently, paced to BROADCAST_RATE messages per second"""
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        interval = 1 / BROADCAST_RATE
+        next_send = time.monotonic()
+        # Serialize the digest once; each request only splices in its chat_id
+        prefix = b'{"chat_id":'
+        suffix = (
+            b',"text":' + json.dumps(digest, ensure_ascii=False).encode()
+            + b',"parse_mode":"Markdown"}'
+        )
+        headers = {"Content-Type": "application/json"}
+
+        async def _send(user_id: int):
+            nonlocal next_send
+            async with sem:
+                try:
+                    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+                        # The semaphore only bounds requests in flight; the rate is set by
+                        # handing each send the next free start slot on a shared clock
+                        now = time.monotonic()
+                        slot = max(next_send, now)
+                        next_send = slot + interval
+                        await asyncio.sleep(slot - now)
+
+                        response = await self._http.post(
+                            "/sendMessage",
+                            content=prefix + str(user_id).encode() + suffix,
+                            headers=headers
+                        )
+                        result = response.json()
+                        if result.get("ok"):
+                            return
+                        if result.get("error_code") != 429 or attempt == BROADCAST_MAX_RETRIES:
+                            raise RuntimeError(result.get("description", f"HTTP {response.status_code}"))
+                        # Throttled: the limit is per bot, so hold back every sender
+                        # for retry_after, then retry this user
+                        retry_after = result.get("parameters", {}).get("retry_after", 1)
+                        logger.warning(f"Throttled sending digest to user {user_id}, retrying in {retry_after}s")
+                        next_send = max(next_send, time.monotonic() + retry_after)
+                except Exception as e:
+                    logger.error(f"Failed to send digest to user {user_id}: {e}")
+
+        await asyncio.gather(*(_send(user_id) for user_id in user_ids))
+
     async def handle_forwarded_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         
@@ -221,7 +267,7 @@ class EzraBot:
                 # Save the forwarded message content if it exists
                 message_content = update.message.text or update.message.caption
                 if message_content:
-                    content_hash = hashlib.md5(message_content.encode()).hexdigest()
+                    content_hash = hash_content(message_content)
                     message_date = update.message.forward_origin.date if hasattr(update.message.forward_origin, 'date') else update.message.date
                     
                     message_saved = await self.db.add_message(
@@ -248,7 +294,7 @@ class EzraBot:
         try:
             logger.info("Starting digest generation...")
             
-            messages = await self.db.get_unprocessed_messages()
+            messages = [msg async for msg in self.db.iter_unprocessed_messages()]
             
             if not messages:
                 logger.info("No new messages to process")
@@ -257,23 +303,12 @@ class EzraBot:
             # Pass full message data for source link generation
             digest = await self.llm.generate_digest_with_sources(messages)
             
-            today = datetime.now().strftime("%Y-%m-%d")
-            await self.db.save_digest(today, digest)
-            
+            today = time.strftime("%Y-%m-%d")
             message_ids = [msg[0] for msg in messages]
-            await self.db.mark_messages_processed(message_ids)
+            await self.db.finalize_digest(today, digest, message_ids)
             
             subscribed_users = await self.db.get_subscribed_users()
-            
-            for user_id in subscribed_users:
-                try:
-                    await self.application.bot.send_message(
-                        chat_id=user_id,
-                        text=digest,
-                        parse_mode='Markdown'
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send digest to user {user_id}: {e}")
+            await self._broadcast_digest(digest, subscribed_users)
             
             logger.info(f"Digest sent to {len(subscribed_users)} users")
             
@@ -291,21 +326,28 @@ class EzraBot:
         logger.info("Scheduler started - daily digest will be sent at 08:00")
 
     async def run(self):
-        await self.initialize()
-        self.start_scheduler()
-        
-        logger.info("Starting Ezra bot...")
-        await self.application.initialize()
-        await self.application.start()
-        await self.application.updater.start_polling()
-        
+        # Startup runs inside the try so a failure still closes the database;
+        # its connection threads would otherwise keep the process alive
         try:
+            await self.initialize()
+            self.start_scheduler()
+            
+            logger.info("Starting Ezra bot...")
+            await self.application.initialize()
+            await self.application.start()
+            await self.application.updater.start_polling()
+            
             await asyncio.Event().wait()
         except KeyboardInterrupt:
             logger.info("Shutting down...")
         finally:
-            await self.application.stop()
-            self.scheduler.shutdown()
+            if self.application is not None and self.application.running:
+                await self.application.stop()
+            if self.scheduler.running:
+                self.scheduler.shutdown()
+            if self._http is not None:
+                await self._http.aclose()
+            await self.db.close()
 
 
 async def main():
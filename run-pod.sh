@@ -5,7 +5,9 @@
 
 POD_NAME="ezra-pod"
 MAIN_CONTAINER="ezra-telegram-bot"
-USERBOT_CONTAINER="ezra-userbot-cron"
+USERBOT_CONTAINER="ezra-userbot"
+# Name used while the userbot ran under cron; removed on start so it can't run alongside
+LEGACY_USERBOT_CONTAINER="ezra-userbot-cron"
 
 # Colors for output
 RED='\033[0;31m'
@@ -114,10 +116,12 @@ start_main_bot() {
 start_userbot() {
     print_status "Starting userbot container..."
     
-    if container_exists "$USERBOT_CONTAINER"; then
-        print_warning "Removing existing container: $USERBOT_CONTAINER"
-        podman rm -f "$USERBOT_CONTAINER"
-    fi
+    for container in "$USERBOT_CONTAINER" "$LEGACY_USERBOT_CONTAINER"; do
+        if container_exists "$container"; then
+            print_warning "Removing existing container: $container"
+            podman rm -f "$container"
+        fi
+    done
     
     podman run -d \
         --name "$USERBOT_CONTAINER" \
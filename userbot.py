@@ -1,40 +1,80 @@
 import os
 import asyncio
 import logging
-import hashlib
+import logging.handlers
+import queue
 from typing import List
 from datetime import datetime
 
 from telethon import TelegramClient
+from telethon.hints import Entity
 from telethon.tl.functions.messages import GetDialogFiltersRequest
-from telethon.tl.types import DialogFilterDefault
+from telethon.tl.types import Channel, DialogFilterDefault
 from dotenv import load_dotenv
 
-from database import Database
+from database import Database, hash_content
 
-# Load environment variables
-load_dotenv('config/credentials.env')
+# Load environment variables, unless the caller (e.g. the container's env file) already exported them
+if not os.getenv("TELEGRAM_API_ID"):
+    load_dotenv('config/credentials.env')
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+FETCH_CONCURRENCY = 5
+# Telethon sleeps through FloodWaits up to this many seconds and raises on longer
+# ones. 60 is Telethon's own default; it is pinned here only to make the policy visible
+FLOOD_SLEEP_THRESHOLD = 60
+
+# Parsed once at import; missing credentials are reported by EzraUserbot()
+API_ID = int(os.environ["TELEGRAM_API_ID"]) if os.getenv("TELEGRAM_API_ID") else None
+API_HASH = os.getenv("TELEGRAM_API_HASH")
+PHONE_NUMBER = os.getenv("TELEGRAM_PHONE_NUMBER")
+FOLDER_NAME = os.getenv("TELEGRAM_FOLDER_NAME", "AI")  # Default to "AI"
+SESSION_FILE = "/app/config/userbot.session"
+BATCH_INTERVAL_SEC = int(os.getenv("BATCH_INTERVAL_SEC", "3600"))  # hourly, like the old cron job
+
+
+def _setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue drained by a listener thread; the caller stops it"""
+    # Log calls only enqueue the record; the listener does the formatting and the
+    # blocking stderr writes, so the event loop never waits on the terminal
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    # The queue side only merges args into the message; the listener adds the rest
+    logging.basicConfig(format="%(message)s", level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+def _filter_title(dialog_filter) -> str | None:
+    """Folder title as plain text, or None for filters without one (e.g. the default)"""
+    title = getattr(dialog_filter, 'title', None)
+    if title is None:
+        return None
+    # Handle both string and TextWithEntities objects
+    return (title.text if hasattr(title, 'text') else str(title)).strip()
+
 
 class EzraUserbot:
     def __init__(self):
-        self.api_id = os.getenv("TELEGRAM_API_ID")
-        self.api_hash = os.getenv("TELEGRAM_API_HASH")
-        self.phone = os.getenv("TELEGRAM_PHONE_NUMBER")
-        self.folder_name = os.getenv("TELEGRAM_FOLDER_NAME", "AI")  # Default to "AI"
-        self.session_file = "/app/config/userbot.session"
+        self.api_id = API_ID
+        self.api_hash = API_HASH
+        self.phone = PHONE_NUMBER
+        self.folder_name = FOLDER_NAME
+        self.session_file = SESSION_FILE
         
         if not all([self.api_id, self.api_hash, self.phone]):
             raise ValueError("Missing required Telegram API credentials in config/credentials.env")
         
         logger.info(f"Using Telegram folder: '{self.folder_name}'")
-        self.client = TelegramClient(self.session_file, int(self.api_id), self.api_hash)
-        self.db = Database()
+        self.client = TelegramClient(
+            self.session_file, self.api_id, self.api_hash, flood_sleep_threshold=FLOOD_SLEEP_THRESHOLD
+        )
+        # One read connection per concurrent fetch, plus the pool's writer
+        self.db = Database(pool_size=FETCH_CONCURRENCY + 1)
+        self._sem = asyncio.Semaphore(FETCH_CONCURRENCY)
 
     async def initialize(self):
         """Initialize database and Telegram client"""
@@ -49,7 +89,7 @@ class EzraUserbot:
         me = await self.client.get_me()
         logger.info(f"Logged in as: {me.first_name} {me.last_name or ''} (@{me.username or 'no username'})")
 
-    async def find_target_folder_chats(self) -> List[int]:
+    async def find_target_folder_chats(self) -> List[Entity]:
         """Find all chats in the configured folder ONLY"""
         target_chats = []
         
@@ -58,44 +98,34 @@ class EzraUserbot:
             result = await self.client(GetDialogFiltersRequest())
             logger.info(f"Found {len(result.filters)} total folders")
             
-            # Debug: list all folder names
-            for i, dialog_filter in enumerate(result.filters):
-                if hasattr(dialog_filter, 'title'):
-                    if hasattr(dialog_filter.title, 'text'):
-                        folder_name = dialog_filter.title.text
-                    else:
-                        folder_name = str(dialog_filter.title)
-                else:
-                    folder_name = f'Folder {i}'
-                logger.info(f"Folder {i}: '{folder_name}'")
-            
-            target_folder = None
+            # Index folders by title once; the first folder with a given title wins
+            folders = {}
             for dialog_filter in result.filters:
-                if hasattr(dialog_filter, 'title'):
-                    # Handle both string and TextWithEntities objects
-                    if hasattr(dialog_filter.title, 'text'):
-                        title = dialog_filter.title.text.strip()
-                    else:
-                        title = str(dialog_filter.title).strip()
-                    
-                    logger.info(f"Checking folder: '{title}' (lowercase: '{title.lower()}')")
-                    if title.lower() == self.folder_name.lower():
-                        target_folder = dialog_filter
-                        logger.info(f"✅ Found target folder '{self.folder_name}' with {len(dialog_filter.include_peers)} chats")
-                        break
+                title = _filter_title(dialog_filter)
+                logger.debug("Folder: %s", title)
+                if title:
+                    folders.setdefault(title.casefold(), (title, dialog_filter))
+            
+            _, target_folder = folders.get(self.folder_name.casefold(), (None, None))
             
             if target_folder:
-                # Get chats from target folder
-                for peer in target_folder.include_peers:
-                    try:
-                        entity = await self.client.get_entity(peer)
-                        target_chats.append(entity.id)
-                        chat_name = getattr(entity, 'title', getattr(entity, 'first_name', f'Chat {entity.id}'))
-                        logger.info(f"✅ Added folder chat: {chat_name} (ID: {entity.id})")
-                    except Exception as e:
-                        logger.error(f"❌ Error getting entity for peer {peer}: {e}")
+                logger.info(f"✅ Found target folder '{self.folder_name}' with {len(target_folder.include_peers)} chats")
+                
+                # Resolve all chats from target folder concurrently (gather keeps peer order)
+                peers = target_folder.include_peers
+                entities = await asyncio.gather(
+                    *(self.client.get_entity(peer) for peer in peers), return_exceptions=True
+                )
+                for peer, entity in zip(peers, entities):
+                    if isinstance(entity, Exception):
+                        logger.error(f"❌ Error getting entity for peer {peer}: {entity}")
+                        continue
+                    target_chats.append(entity)
+                    chat_name = getattr(entity, 'title', None) or getattr(entity, 'first_name', None) or f'Chat {entity.id}'
+                    logger.info(f"✅ Added folder chat: {chat_name} (ID: {entity.id})")
             else:
-                logger.error(f"❌ Folder '{self.folder_name}' not found! Available folders listed above.")
+                available = ", ".join(f"'{title}'" for title, _ in folders.values())
+                logger.error(f"❌ Folder '{self.folder_name}' not found! Available folders: {available}")
                 logger.error(f"❌ Make sure you have a folder named exactly '{self.folder_name}' in Telegram")
                 logger.error(f"❌ You can change the folder name with TELEGRAM_FOLDER_NAME environment variable")
                 logger.error("❌ NO CHATS WILL BE PROCESSED")
@@ -109,102 +139,123 @@ class EzraUserbot:
         logger.info(f"✅ Found {len(target_chats)} chats in '{self.folder_name}' folder to process")
         return target_chats
 
-    async def fetch_recent_messages(self, chat_id: int, limit: int = 10) -> int:
+    async def fetch_recent_messages(self, entity: Entity, limit: int = 10) -> int:
         """Fetch recent messages from a specific chat"""
-        messages_saved = 0
+        async with self._sem:
+            messages_saved = 0
+            rows = []
         
-        try:
-            # Get chat info for logging
-            entity = await self.client.get_entity(chat_id)
-            chat_name = getattr(entity, 'title', getattr(entity, 'first_name', f'Chat {chat_id}'))
-            chat_username = getattr(entity, 'username', None)
+            try:
+                # Entity was already resolved while reading the folder
+                chat_id = entity.id
+                chat_name = getattr(entity, 'title', None) or getattr(entity, 'first_name', None) or f'Chat {chat_id}'
+                chat_username = getattr(entity, 'username', None)
             
-            logger.info(f"Fetching last {limit} messages from {chat_name} (@{chat_username})")
+                logger.info(f"Fetching last {limit} messages from {chat_name} (@{chat_username})")
             
-            # Get recent messages
-            async for message in self.client.iter_messages(entity, limit=limit):
-                if not message.message:  # Skip messages without text content
-                    continue
+                # Link prefix is a per-chat invariant; messages only append their id
+                link_prefix = None
+                if chat_username:
+                    # Public channel with username
+                    link_prefix = f"https://t.me/{chat_username}/"
+                elif isinstance(entity, Channel):
+                    # Private channel/supergroup - use c/ format with the bare
+                    # channel ID (entity.id carries no -100 prefix)
+                    link_prefix = f"https://t.me/c/{entity.id}/"
+                logger.debug("Link prefix for %s: %s", chat_name, link_prefix)
                 
-                # Create content hash
-                content_hash = hashlib.md5(message.message.encode()).hexdigest()
+                # Only ask for messages newer than the last one stored; min_id
+                # is filtered server-side, so a quiet chat returns nothing
+                last_id = await self.db.get_max_tg_message_id(chat_id)
+                messages = await self.client.get_messages(entity, limit=limit, min_id=last_id)
+                for message in messages:
+                    text = message.message
+                    if not text or text.isspace():  # Skip messages without text content
+                        continue
                 
-                # Build message link if possible
-                message_link = None
-                if chat_username and message.id:
-                    # Public channel with username
-                    message_link = f"https://t.me/{chat_username}/{message.id}"
-                    logger.info(f"Built public link: {message_link}")
-                elif message.id and chat_id < 0:
-                    # Private channel/group - use c/ format with channel ID
-                    # Remove the -100 prefix that Telegram adds to channel IDs
-                    channel_id_str = str(abs(chat_id))
-                    if channel_id_str.startswith('100'):
-                        channel_id_str = channel_id_str[3:]  # Remove '100' prefix
-                    message_link = f"https://t.me/c/{channel_id_str}/{message.id}"
-                    logger.info(f"Built private link: {message_link}")
-                else:
-                    logger.info(f"No link possible - username: {chat_username}, msg_id: {message.id}, chat_id: {chat_id}")
+                    message_link = f"{link_prefix}{message.id}" if link_prefix and message.id else None
                 
-                # Try to save to database
-                logger.info(f"Attempting to save with link: {message_link}")
-                success = await self.db.add_message(
-                    chat_id, message.message, message.date, content_hash, source='userbot', message_link=message_link
-                )
+                    rows.append((chat_id, message.id, text, message.date, hash_content(text), 'userbot', message_link))
                 
-                if success:
-                    messages_saved += 1
-                    logger.info(f"✅ Saved new message from {chat_name}: {message.message[:50]}...")
-                else:
-                    logger.info(f"❌ Failed to save message from {chat_name} (likely duplicate)")
+                # Save the whole chat in one round-trip; duplicates are skipped in SQL
+                messages_saved = await self.db.add_messages_bulk(rows)
+                logger.info(f"✅ Saved {messages_saved} new of {len(rows)} messages from {chat_name}")
             
-        except Exception as e:
-            logger.error(f"Error fetching messages from chat {chat_id}: {e}")
+            except Exception as e:
+                logger.error(f"Error fetching messages from chat {entity.id}: {e}")
         
-        return messages_saved
+            return messages_saved
 
-    async def run_batch(self):
-        """Run batch job: fetch recent messages and exit"""
+    async def _run_batch_once(self) -> int:
+        """Fetch recent messages from every folder chat; the client must already be initialized"""
         total_messages_saved = 0
         
+        # Telethon stops retrying after repeated connection failures; without
+        # this every later batch would fail, while cron started each run fresh
+        if not self.client.is_connected():
+            logger.warning("Telegram client disconnected, reconnecting")
+            await self.client.connect()
+        
+        # Find target folder chats
+        target_chats = await self.find_target_folder_chats()
+        
+        if not target_chats:
+            logger.info(f"No chats found in '{self.folder_name}' folder, skipping batch")
+            return 0
+        
+        # Process chats concurrently; the semaphore caps in-flight Telethon calls
+        tasks = [asyncio.create_task(self.fetch_recent_messages(entity, limit=10)) for entity in target_chats]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        for entity, result in zip(target_chats, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error processing chat {entity.id}: {result}")
+            else:
+                total_messages_saved += result
+        
+        logger.info(f"Batch job completed. Saved {total_messages_saved} new messages from {len(target_chats)} chats in '{self.folder_name}' folder")
+        return total_messages_saved
+
+    async def close(self):
+        """Disconnect from Telegram and close the database"""
+        if self.client.is_connected():
+            await self.client.disconnect()
+            logger.info("Disconnected from Telegram")
+        await self.db.close()
+
+    async def run_batch(self):
+        """Run batch job: fetch recent messages and exit"""
         try:
             await self.initialize()
-            
-            # Find target folder chats
-            target_chats = await self.find_target_folder_chats()
-            
-            if not target_chats:
-                logger.info(f"No chats found in '{self.folder_name}' folder, exiting")
-                return
-            
-            # Process each chat
-            for chat_id in target_chats:
-                try:
-                    messages_saved = await self.fetch_recent_messages(chat_id, limit=10)
-                    total_messages_saved += messages_saved
-                    
-                    # Small delay between chats to avoid rate limiting
-                    await asyncio.sleep(1)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing chat {chat_id}: {e}")
-                    continue
-            
-            logger.info(f"Batch job completed. Saved {total_messages_saved} new messages from {len(target_chats)} chats in '{self.folder_name}' folder")
-            
+            await self._run_batch_once()
         except Exception as e:
             logger.error(f"Error in batch job: {e}")
             raise
         finally:
-            if self.client.is_connected():
-                await self.client.disconnect()
-                logger.info("Disconnected from Telegram")
+            await self.close()
+
+    async def run_forever(self):
+        """Connect once, then run a batch every BATCH_INTERVAL_SEC until cancelled"""
+        try:
+            await self.initialize()
+            while True:
+                try:
+                    await self._run_batch_once()
+                except Exception:
+                    logger.exception("Error in batch job")
+                await asyncio.sleep(BATCH_INTERVAL_SEC)
+        finally:
+            await self.close()
 
 
 async def main():
-    userbot = EzraUserbot()
-    await userbot.run_batch()
+    log_listener = _setup_logging()
+    try:
+        userbot = EzraUserbot()
+        await userbot.run_forever()
+    finally:
+        log_listener.stop()  # drains whatever is still queued
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())